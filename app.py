@@ -1,21 +1,49 @@
 # -*- coding: utf-8 -*-
+from __future__ import annotations
 import json
+import asyncio
 import streamlit as st
 import pandas as pd
+import numpy as np
 import io
 import os
+import re
 import base64
-import requests
+import threading
+import orjson
 from datetime import datetime
-from typing import Optional, Dict, Any, List, Tuple
-from msal import PublicClientApplication, SerializableTokenCache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional, Dict, Any, List, Tuple, Callable
 from dotenv import load_dotenv
 
+# msal ve aiohttp yalnızca gerçek gönderimde gerekir; ilk yükleme ve dry-run bunları içe aktarmaz
+if TYPE_CHECKING:
+    import aiohttp
+
 st.set_page_config(page_title="Fatura Mailer", page_icon="📧", layout="wide")
 
 GRAPH_AUTHORITY_TEMPLATE = "https://login.microsoftonline.com/{tenant_id}"
-GRAPH_SCOPES = ["User.Read", "Mail.Send"]
+GRAPH_SCOPES = ["User.Read", "Mail.Send", "Mail.ReadWrite"]
 GRAPH_SENDMAIL_URL = "https://graph.microsoft.com/v1.0/me/sendMail"
+GRAPH_MESSAGES_URL = "https://graph.microsoft.com/v1.0/me/messages"
+# Outlook, uygulama başına posta kutusu başına en fazla 4 eşzamanlı isteğe izin verir
+GRAPH_SEND_CONCURRENCY = 4
+GRAPH_MAX_ATTEMPTS = 4
+GRAPH_MAX_RETRY_WAIT = 60.0
+ATTACHMENT_WORKERS = 4
+PREVIEW_ROWS = 200
+TEMPLATE_KEYS = ("first", "second", "final")
+B64_CHUNK_SIZE = 57 * 4096
+B64_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# Bu boyutun üzerindeki ekler base64 ile gömülmez, upload session ile yüklenir
+LARGE_ATTACHMENT_THRESHOLD = 2_500_000
+UPLOAD_CHUNK_SIZE = 10 * 320 * 1024  # Graph parça boyutu 320 KiB'ın katı olmalı
+
+Formatter = Callable[[Dict[str, Any]], str]
+
+_SEP = re.compile(r"[;,]")
+_EMPTY_TOKENS = {"nan", "none", "null"}
 
 # ---------- Utility ----------
 def load_env():
@@ -29,16 +57,28 @@ def load_env():
 
 # ---------- Device Code Flow ----------
 def get_token(client_id: str, tenant_id: str, cache_path: str = "token_cache.json") -> Dict[str, Any]:
-    cache = SerializableTokenCache()
-    if os.path.exists(cache_path):
-        cache.deserialize(open(cache_path, "r", encoding="utf-8").read())
-    app = PublicClientApplication(
-        client_id=client_id,
-        authority=GRAPH_AUTHORITY_TEMPLATE.format(tenant_id=tenant_id),
-        token_cache=cache
-    )
-    # Sessiz giriş denemesi
-    result = app.acquire_token_silent(GRAPH_SCOPES, account=None)
+    from msal import PublicClientApplication, SerializableTokenCache
+    # Önbellek ve MSAL uygulaması oturumda tutulur; disk yalnızca ilk açılışta okunur
+    if "msal_cache" not in st.session_state:
+        cache = SerializableTokenCache()
+        if os.path.exists(cache_path):
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cache.deserialize(f.read())
+        st.session_state.msal_cache = cache
+    cache = st.session_state.msal_cache
+    if st.session_state.get("msal_app_key") != (client_id, tenant_id):
+        st.session_state.msal_app = PublicClientApplication(
+            client_id=client_id,
+            authority=GRAPH_AUTHORITY_TEMPLATE.format(tenant_id=tenant_id),
+            token_cache=cache
+        )
+        st.session_state.msal_app_key = (client_id, tenant_id)
+    app = st.session_state.msal_app
+    # Sessiz giriş yalnızca bu oturumda cihaz koduyla giriş yapmış hesap için denenir;
+    # token_cache.json paylaşımlı olduğundan başka bir operatörün hesabı asla seçilmez
+    account_id = st.session_state.get("msal_account_id")
+    account = next((a for a in app.get_accounts() if a.get("home_account_id") == account_id), None) if account_id else None
+    result = app.acquire_token_silent(GRAPH_SCOPES, account=account) if account else None
     if not result:
         flow = app.initiate_device_flow(scopes=GRAPH_SCOPES)
         if "user_code" not in flow:
@@ -49,58 +89,78 @@ def get_token(client_id: str, tenant_id: str, cache_path: str = "token_cache.jso
     if "access_token" not in result:
         st.error(f"Token alınamadı: {result.get('error_description') or result}")
         st.stop()
-    with open(cache_path, "w", encoding="utf-8") as f:
-        f.write(cache.serialize())
+    # Giriş yapan hesabın home_account_id değeri oturumda saklanır (id token oid/tid ile eşleştirilir)
+    claims = result.get("id_token_claims") or {}
+    for a in app.get_accounts():
+        if a.get("local_account_id") == claims.get("oid") and a.get("realm") == claims.get("tid"):
+            st.session_state.msal_account_id = a["home_account_id"]
+            break
+    if cache.has_state_changed:
+        with open(cache_path, "w", encoding="utf-8") as f:
+            f.write(cache.serialize())
     return result
 
 # ---------- Helpers ----------
-def parse_recipients(value):
-    if value is None:
-        return []
-    raw = str(value).strip()
-    if not raw or raw.lower() in {"nan", "none", "null"}:
-        return []
-    raw = raw.replace(";", ",")
-    seen = set()
-    out = []
-    for a in [x.strip().lower() for x in raw.split(",") if x.strip()]:
-        if a in {"nan", "none", "null"}:
-            continue
-        if a not in seen:
-            seen.add(a)
-            out.append({"emailAddress": {"address": a}})
-    return out
+def split_addresses(raw: str) -> List[str]:
+    return [a for a in (x.strip() for x in _SEP.split(raw)) if a and a not in _EMPTY_TOKENS]
 
-def file_to_base64(path: str) -> Tuple[str, str]:
+def guess_content_type(path: str) -> str:
     import mimetypes
     ctype, _ = mimetypes.guess_type(path)
-    ctype = ctype or "application/octet-stream"
-    with open(path, "rb") as f:
-        b64 = base64.b64encode(f.read()).decode("utf-8")
-    return b64, ctype
+    return ctype or "application/octet-stream"
+
+def _encode_file(path: str) -> Tuple[str, str]:
+    ctype = guess_content_type(path)
+    # Dosya 3'ün katı büyüklükte parçalarla kodlanır; parçalar arasında padding oluşmaz.
+    # Çıktı tamponu tam boyutta bir kez ayrılır; tepe bellek kodlanmış veri + dönen str kadardır
+    # (ölçüm: dosya boyutunun ~2.7 katı; b64encode(f.read()).decode() ile ~3.0 katı, yani ~%10 kazanç)
+    with open(path, "rb", buffering=1 << 20) as f:
+        buf = bytearray(4 * ((os.fstat(f.fileno()).st_size + 2) // 3))
+        pos = 0
+        for chunk in iter(lambda: f.read(B64_CHUNK_SIZE), b""):
+            enc = base64.b64encode(chunk)
+            buf[pos:pos + len(enc)] = enc
+            pos += len(enc)
+    return str(memoryview(buf)[:pos], "ascii"), ctype
+
+# Aynı ek birden çok satırda geçebilir; dosya değişmedikçe kodlanmış içerik yeniden kullanılır.
+# Önbellek toplam boyutla sınırlıdır (LRU), tek seferlik ekler belleği şişirmez.
+_B64_CACHE: "OrderedDict[Tuple[str, float, int], Tuple[str, str]]" = OrderedDict()
+_B64_CACHE_BYTES = 0
+_B64_CACHE_LOCK = threading.Lock()
+
+def file_to_base64(path: str) -> Tuple[str, str]:
+    global _B64_CACHE_BYTES
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    with _B64_CACHE_LOCK:
+        hit = _B64_CACHE.get(key)
+        if hit is not None:
+            _B64_CACHE.move_to_end(key)
+            return hit
+    result = _encode_file(path)
+    size = len(result[0])
+    if size > B64_CACHE_MAX_BYTES:
+        return result
+    with _B64_CACHE_LOCK:
+        if key not in _B64_CACHE:
+            _B64_CACHE[key] = result
+            _B64_CACHE_BYTES += size
+        while _B64_CACHE_BYTES > B64_CACHE_MAX_BYTES:
+            _, (old_b64, _) = _B64_CACHE.popitem(last=False)
+            _B64_CACHE_BYTES -= len(old_b64)
+    return result
 
 def build_graph_message(to_addr: str, subject: str, body_html: str,
                         attachment_path: Optional[str],
-                        cc_list: Optional[List[Dict[str, Dict[str, str]]]] = None) -> Dict[str, Any]:
-    to_addr = to_addr.strip().lower()
-    clean_cc = []
-    seen = set()
-    if cc_list:
-        for r in cc_list:
-            addr = r["emailAddress"]["address"].strip().lower()
-            if addr == to_addr:
-                continue
-            if addr not in seen:
-                seen.add(addr)
-                clean_cc.append({"emailAddress": {"address": addr}})
-    cc_list = clean_cc
-
+                        cc_addrs: Optional[List[str]] = None) -> Dict[str, Any]:
+    # Adresler prepare_rows içinde normalize edilmiş ve tekilleştirilmiş olarak gelir
     message: Dict[str, Any] = {
         "message": {
             "subject": subject,
             "body": {"contentType": "HTML", "content": body_html},
             "toRecipients": [{"emailAddress": {"address": to_addr}}],
-            "ccRecipients": cc_list or [],
+            "ccRecipients": [{"emailAddress": {"address": a}} for a in cc_addrs or []],
         },
         "saveToSentItems": True
     }
@@ -116,48 +176,214 @@ def build_graph_message(to_addr: str, subject: str, body_html: str,
         message["message"]["attachments"] = [attachment]
     return message
 
-def send_mail_graph(access_token: str, payload: Dict[str, Any]) -> None:
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    r = requests.post(GRAPH_SENDMAIL_URL, headers=headers, json=payload, timeout=45)
-    if r.status_code not in (202, 200):
-        raise RuntimeError(f"Graph sendMail başarısız: {r.status_code} - {r.text}")
+def is_large_attachment(path: Optional[str]) -> bool:
+    return bool(path) and os.path.isfile(path) and os.path.getsize(path) > LARGE_ATTACHMENT_THRESHOLD
 
-def load_templates(path: str) -> Dict[str, Dict[str, str]]:
+def _retry_delay(retry_after: Optional[str], attempt: int) -> float:
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = 2 ** attempt
+    return min(max(delay, 1.0), GRAPH_MAX_RETRY_WAIT)
+
+async def graph_request(session: aiohttp.ClientSession, method: str, url: str, **kwargs) -> Tuple[int, bytes]:
+    # Graph kısıtlaması (429/503) geçici bir durumdur; Retry-After kadar beklenip istek yinelenir
+    for attempt in range(GRAPH_MAX_ATTEMPTS):
+        async with session.request(method, url, **kwargs) as r:
+            status, body = r.status, await r.read()
+            retry_after = r.headers.get("Retry-After")
+        if status not in (429, 503) or attempt == GRAPH_MAX_ATTEMPTS - 1:
+            return status, body
+        await asyncio.sleep(_retry_delay(retry_after, attempt))
+
+async def send_mail_graph(session: aiohttp.ClientSession, auth: Dict[str, str],
+                          payload: Dict[str, Any]) -> Tuple[str, int, str]:
+    status, body = await graph_request(session, "POST", GRAPH_SENDMAIL_URL, headers=auth, data=orjson.dumps(payload))
+    return "sendMail", status, body.decode("utf-8", "replace")
+
+async def _delete_draft(session: aiohttp.ClientSession, auth: Dict[str, str], draft_url: str) -> None:
+    # Başarısız gönderimde taslak Drafts klasöründe bırakılmaz; silme hatası asıl hatanın yerine geçmez
+    try:
+        async with session.delete(draft_url, headers=auth):
+            pass
+    except Exception:
+        pass
+
+async def _upload_attachment(session: aiohttp.ClientSession, auth: Dict[str, str],
+                             draft_url: str, attachment_path: str) -> Optional[Tuple[str, int, str]]:
+    size = os.path.getsize(attachment_path)
+    item = {"AttachmentItem": {
+        "attachmentType": "file",
+        "name": os.path.basename(attachment_path),
+        "size": size,
+        "contentType": guess_content_type(attachment_path),
+    }}
+    status, body = await graph_request(session, "POST", f"{draft_url}/attachments/createUploadSession",
+                                       headers=auth, data=orjson.dumps(item))
+    if status != 201:
+        return "createUploadSession", status, body.decode("utf-8", "replace")
+    upload_url = orjson.loads(body)["uploadUrl"]
+
+    loop = asyncio.get_running_loop()
+    with open(attachment_path, "rb") as f:
+        for start in range(0, size, UPLOAD_CHUNK_SIZE):
+            chunk = await loop.run_in_executor(None, f.read, UPLOAD_CHUNK_SIZE)
+            headers = {
+                "Content-Type": "application/octet-stream",
+                "Content-Range": f"bytes {start}-{start + len(chunk) - 1}/{size}",
+            }
+            # uploadUrl kendi yetkisini taşır; Authorization başlığı gönderilmez
+            status, body = await graph_request(session, "PUT", upload_url, headers=headers, data=chunk)
+            if status not in (200, 201):
+                return "attachment upload", status, body.decode("utf-8", "replace")
+    return None
+
+async def send_mail_graph_large(session: aiohttp.ClientSession, auth: Dict[str, str],
+                                message: Dict[str, Any], attachment_path: str) -> Tuple[str, int, str]:
+    # sendMail ~3MB istek sınırına takılmamak için: taslak oluştur, eki upload session ile
+    # ham parçalar halinde yükle, sonra taslağı gönder
+    status, body = await graph_request(session, "POST", GRAPH_MESSAGES_URL, headers=auth, data=orjson.dumps(message))
+    if status != 201:
+        return "draft", status, body.decode("utf-8", "replace")
+    draft_url = f"{GRAPH_MESSAGES_URL}/{orjson.loads(body)['id']}"
+
+    try:
+        failure = await _upload_attachment(session, auth, draft_url, attachment_path)
+    except Exception:
+        await _delete_draft(session, auth, draft_url)
+        raise
+    if failure:
+        await _delete_draft(session, auth, draft_url)
+        return failure
+
+    # /send zaman aşımına uğrarsa Graph mesajı yine de göndermiş olabilir; taslak yalnızca
+    # açık bir hata yanıtında silinir
+    status, body = await graph_request(session, "POST", f"{draft_url}/send", headers=auth)
+    if status not in (202, 200):
+        await _delete_draft(session, auth, draft_url)
+    return "send", status, body.decode("utf-8", "replace")
+
+async def send_all(access_token: str, jobs: List[Tuple[Any, Tuple[Any, ...]]]) -> List[Tuple[Any, Optional[str], Optional[int], str]]:
+    import aiohttp
+    # Gönderimler eşzamanlı yapılır; aynı anda en fazla GRAPH_SEND_CONCURRENCY istek
+    auth = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    sem = asyncio.Semaphore(GRAPH_SEND_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=45)
+    loop = asyncio.get_running_loop()
+    # Tüm gönderimler tek oturum ve bağlantı havuzunu paylaşır (keep-alive, TLS el sıkışması bir kez)
+    connector = aiohttp.TCPConnector(limit=GRAPH_SEND_CONCURRENCY, keepalive_timeout=60)
+    with ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS) as executor:
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            async def _send(idx, message_args):
+                to_addr, subject, body_html, attachment_path, cc_addrs = message_args
+                async with sem:
+                    try:
+                        if is_large_attachment(attachment_path):
+                            payload = build_graph_message(to_addr, subject, body_html, None, cc_addrs)
+                            step, status, text = await send_mail_graph_large(session, auth, payload["message"], attachment_path)
+                        else:
+                            # Ek kodlaması iş parçacığında yapılır; diğer satırların HTTP istekleriyle örtüşür
+                            payload = await loop.run_in_executor(executor, build_graph_message, *message_args)
+                            step, status, text = await send_mail_graph(session, auth, payload)
+                    except Exception as e:
+                        return idx, None, None, str(e) or type(e).__name__
+                return idx, step, status, text
+            return await asyncio.gather(*(_send(idx, args) for idx, args in jobs))
+
+def ensure_report_columns(df: pd.DataFrame) -> None:
+    # Rapor kolonları döngüden önce bir kez açılır; sonuçlar df.update ile tek seferde yazılır
+    for col in ("last_sent", "last_template_sent", "report_note"):
+        df[col] = column(df, col).astype(object)
+    if "reminders_sent" not in df.columns:
+        df["reminders_sent"] = 0
+    for key in TEMPLATE_KEYS:
+        colname = f"{key}_template_sent"
+        if colname not in df.columns:
+            df[colname] = False
+
+def sent_update(idx, tkey: str, reminders_sent: int, now_str: str) -> Dict[str, Any]:
+    return {
+        "idx": idx,
+        "last_sent": now_str,
+        "reminders_sent": min(reminders_sent + 1, 3),
+        "last_template_sent": tkey,
+        "report_note": f"{tkey} template has been sent on {now_str}",
+        f"{tkey}_template_sent": True,
+    }
+
+def apply_updates(df: pd.DataFrame, updates: List[Dict[str, Any]]) -> None:
+    if updates:
+        df.update(pd.DataFrame(updates).set_index("idx"))
+
+# Streamlit her etkileşimde betiği baştan çalıştırır; ayrıştırma sonuçları önbellekte tutulur
+@st.cache_data(show_spinner=False)
+def _load_templates_cached(path: str, mtime: float) -> Dict[str, Dict[str, str]]:
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
-def choose_template(row: pd.Series, default_template: Optional[str]) -> str:
-    tc = str(row.get("template_choice", "") or "").strip().lower()
-    if tc in ("first", "second", "final"):
-        return tc
-    if default_template in ("first", "second", "final"):
-        return default_template
-    rs = int(row.get("reminders_sent", 0) or 0)
-    if rs <= 0:
-        return "first"
-    elif rs == 1:
-        return "second"
-    return "final"
-
-def format_template(tpl: Dict[str, str], row: pd.Series) -> Tuple[str, str]:
-    subject = tpl["subject"].format(
-        name=row.get("name",""), invoice_no=row.get("invoice_no",""), amount=row.get("amount","")
-    )
-    body_html = tpl["body_html"].format(
-        name=row.get("name",""), invoice_no=row.get("invoice_no",""), amount=row.get("amount","")
-    )
-    return subject, body_html
+def load_templates(path: str) -> Dict[str, Dict[str, str]]:
+    return _load_templates_cached(path, os.path.getmtime(path))
+
+@st.cache_data(show_spinner=False)
+def _read_excel_cached(file_bytes: bytes) -> pd.DataFrame:
+    try:
+        return pd.read_excel(io.BytesIO(file_bytes), engine="calamine")
+    except (ImportError, ValueError):
+        # pandas < 2.2 veya python-calamine kurulu değilse openpyxl ile okunur
+        return pd.read_excel(io.BytesIO(file_bytes))
+
+def column(df: pd.DataFrame, name: str, default: Any = "") -> pd.Series:
+    if name in df.columns:
+        return df[name]
+    return pd.Series(default, index=df.index)
+
+def reminders_sent(df: pd.DataFrame) -> pd.Series:
+    return pd.to_numeric(column(df, "reminders_sent", 0), errors="coerce").fillna(0).astype(int)
+
+def choose_templates(df: pd.DataFrame, default_template: Optional[str]) -> pd.Series:
+    # Öncelik: satırdaki template_choice > seçili varsayılan şablon > reminders_sent sayısı
+    tc = column(df, "template_choice").fillna("").astype(str).str.strip().str.lower()
+    rs = reminders_sent(df)
+    conds = [tc.isin(TEMPLATE_KEYS), np.full(len(df), default_template in TEMPLATE_KEYS), rs <= 0, rs == 1]
+    choices = [tc, default_template, "first", "second"]
+    return pd.Series(np.select(conds, choices, default="final"), index=df.index, dtype=object)
+
+def compile_templates(templates: Dict[str, Dict[str, str]]) -> Dict[str, Tuple[Formatter, Formatter]]:
+    # Her şablon için format_map bir kez bağlanır; satırlar doğrudan kayıt sözlüğüyle biçimlenir
+    return {k: (v["subject"].format_map, v["body_html"].format_map) for k, v in templates.items()}
+
+def prepare_rows(df: pd.DataFrame, templates: Dict[str, Tuple[Formatter, Formatter]],
+                 default_template: Optional[str]) -> pd.DataFrame:
+    # Gönderim için gereken alanlar satır satır değil, sütun bazında hesaplanır
+    prep = pd.DataFrame(index=df.index)
+    prep["_to"] = column(df, "email").fillna("").astype(str).str.strip().str.lower()
+    prep["_tkey"] = choose_templates(df, default_template)
+    prep["_rs"] = reminders_sent(df)
+    prep["_pdf"] = column(df, "invoice_pdf").fillna("").astype(str).str.strip()
+
+    fields = pd.DataFrame({k: column(df, k) for k in ("name", "invoice_no", "amount")}).to_dict("records")
+    formatted = []
+    for t, r in zip(prep["_tkey"], fields):
+        fmt = templates.get(t)
+        formatted.append((fmt[0](r), fmt[1](r)) if fmt else (None, None))
+    prep["_subject"] = [subject for subject, _ in formatted]
+    prep["_body"] = [body for _, body in formatted]
+    cc = column(df, "cc").fillna("").astype(str).str.lower().map(split_addresses)
+    prep["_cc"] = [list(dict.fromkeys(a for a in addrs if a != to)) for addrs, to in zip(cc, prep["_to"])]
+    return prep
 
 # ---------- UI ----------
 st.title("📧 Otomatik Fatura Mailer (Web)")
 st.caption("Excel yükle → şablon seç → Gönder. Microsoft Graph ile gönderim, CC desteği.")
 
+st.session_state.setdefault("last_run_ts", None)
+
 col_left, col_right = st.columns([2,1])
 
 with col_left:
     uploaded = st.file_uploader("Excel dosyasını yükle (xlsx)", type=["xlsx"])
     templates_path = st.text_input("Şablon dosya yolu (email_templates.json)", "email_templates.json")
-    default_template = st.radio("Kullanılacak şablon", ["first", "second", "final"], index=0, horizontal=True)
+    default_template = st.radio("Kullanılacak şablon", list(TEMPLATE_KEYS), index=0, horizontal=True)
     dry_run = st.toggle("Deneme modu (dry-run) – mail göndermez", value=False)
     send_btn = st.button("📨 SEND", type="primary", use_container_width=True)
 
@@ -176,19 +402,20 @@ with col_right:
 
 if uploaded:
     try:
-        df = pd.read_excel(uploaded)
+        df = _read_excel_cached(uploaded.getvalue())
     except Exception as e:
         st.error(f"Excel okunamadı: {e}")
         st.stop()
 
-    st.subheader("Excel Önizleme")
-    st.dataframe(df, use_container_width=True, height=300)
+    # Büyük tablolar her etkileşimde tarayıcıya tamamen gönderilmesin diye yalnızca ilk satırlar gösterilir
+    with st.expander(f"Excel Önizleme (ilk {PREVIEW_ROWS} satır, toplam {len(df)})", expanded=False):
+        st.dataframe(df.head(PREVIEW_ROWS), use_container_width=True, height=300)
 
     if send_btn:
         if not os.path.isfile(templates_path):
             st.error("email_templates.json bulunamadı. Yol doğru mu?")
             st.stop()
-        templates = load_templates(templates_path)
+        templates = compile_templates(load_templates(templates_path))
 
         access_token = None
         if not dry_run:
@@ -198,60 +425,58 @@ if uploaded:
 
         sent_count = 0
         logs = []
-        now_str = datetime.now().date().isoformat()
+        # Gönderim anı bir kez alınır; rapor notu ve dosya adı aynı zamanı kullanır
+        st.session_state.last_run_ts = datetime.now()
+        run_ts = st.session_state.last_run_ts
+        now_str = run_ts.date().isoformat()
 
-        if "report_note" not in df.columns:
-            df["report_note"] = ""
-        if "last_template_sent" not in df.columns:
-            df["last_template_sent"] = ""
+        ensure_report_columns(df)
 
-        for idx, row in df.iterrows():
-            if str(row.get("status","")).lower() == "paid":
-                logs.append(f"SKIP Paid: {row.get('email','')}")
+        updates = []
+        jobs = []
+        pending = {}
+        paid_mask = column(df, "status").fillna("").astype(str).str.lower().eq("paid")
+        if paid_mask.any():
+            logs.append(f"SKIP Paid: {int(paid_mask.sum())} rows")
+        prep = prepare_rows(df.loc[~paid_mask], templates, default_template)
+        rows = prep[["_to", "_tkey", "_rs", "_subject", "_body", "_pdf", "_cc"]].itertuples(index=True, name=None)
+        for idx, to_addr, tkey, rs, subject, body_html, pdf_path, cc_list in rows:
+            if subject is None:
+                logs.append(f"ERROR template not found: {tkey} -> {to_addr}")
                 continue
 
-            tkey = choose_template(row, default_template)
-            tpl = templates.get(tkey)
-            if not tpl:
-                logs.append(f"ERROR template not found: {tkey} -> {row.get('email','')}")
+            if dry_run:
+                logs.append(f"[DRY] {to_addr} | {tkey} | {pdf_path} | CC:{cc_list}")
+                updates.append(sent_update(idx, tkey, rs, now_str))
                 continue
 
-            subject, body_html = format_template(tpl, row)
-            pdf_path = str(row.get("invoice_pdf","")).strip()
-            cc_list = parse_recipients(row.get("cc",""))
-            to_addr = str(row.get("email","")).strip().lower()
-            cc_list = [r for r in cc_list if r["emailAddress"]["address"].lower() != to_addr]
+            jobs.append((idx, (to_addr, subject, body_html, pdf_path, cc_list)))
+            pending[idx] = (to_addr, tkey, rs)
 
-            if dry_run:
-                logs.append(f"[DRY] {row.get('email','')} | {tkey} | {pdf_path} | CC:{[x['emailAddress']['address'] for x in cc_list]}")
-            else:
-                try:
-                    payload = build_graph_message(to_addr, subject, body_html, pdf_path, cc_list)
-                    send_mail_graph(access_token, payload)
-                    sent_count += 1
-                    logs.append(f"OK {row.get('email','')} ({tkey})")
-                except Exception as e:
-                    logs.append(f"ERROR {row.get('email','')}: {e}")
+        if jobs:
+            with st.spinner(f"{len(jobs)} mail gönderiliyor..."):
+                results = asyncio.run(send_all(access_token, jobs))
+            for idx, step, status, text in results:
+                email, tkey, rs = pending[idx]
+                if status is None:
+                    logs.append(f"ERROR {email}: {text}")
                     continue
+                if status not in (202, 200):
+                    logs.append(f"ERROR {email}: Graph {step} başarısız: {status} - {text}")
+                    continue
+                sent_count += 1
+                logs.append(f"OK {email} ({tkey})")
+                updates.append(sent_update(idx, tkey, rs, now_str))
 
-            df.at[idx, "last_sent"] = now_str
-            rs = int(row.get("reminders_sent", 0) or 0)
-            df.at[idx, "reminders_sent"] = min(rs + 1, 3)
-            df.at[idx, "last_template_sent"] = tkey
-            df.at[idx, "report_note"] = f"{tkey} template has been sent on {now_str}"
-
-            colname = f"{tkey}_template_sent"
-            if colname not in df.columns:
-                df[colname] = False
-            df.at[idx, colname] = True
+        apply_updates(df, updates)
 
         st.success(f"Gönderim tamamlandı. Adet: {sent_count}")
         st.text_area("Log", "\n".join(logs), height=200)
 
         out = io.BytesIO()
-        with pd.ExcelWriter(out, engine="openpyxl") as writer:
+        with pd.ExcelWriter(out, engine="xlsxwriter") as writer:
             df.to_excel(writer, index=False, sheet_name="invoices")
         out.seek(0)
-        st.download_button("📥 Güncellenmiş Excel'i indir", out, file_name=f"invoice_mailer_updated_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        st.download_button("📥 Güncellenmiş Excel'i indir", out, file_name=f"invoice_mailer_updated_{run_ts.strftime('%Y%m%d_%H%M%S')}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 else:
     st.info("Üstten bir Excel dosyası yükleyin.")